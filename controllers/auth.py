@@ -1,5 +1,10 @@
+import logging
+import threading
+import time
+from cachetools import TTLCache, cached
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from models.user import User
 from repositories.database_repository import get_db, create_user, get_user_by_email_or_username, get_user_by_email, verify_password
 from pydantic import BaseModel
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -8,6 +13,37 @@ from repositories.auth_repository import create_access_token, verify_token
 # Create the router instance
 auth_router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+logger = logging.getLogger(__name__)
+
+# Short-lived caches so repeated requests with the same token skip the JWT decode and the users query
+_token_cache = TTLCache(maxsize=10_000, ttl=30)
+_user_cache = TTLCache(maxsize=10_000, ttl=30)
+_user_cache_lock = threading.Lock()
+
+@cached(_token_cache, lock=threading.Lock())
+def _decode_cached(token: str):
+    return verify_token(token)
+
+# Dependency to get the authenticated user (FastAPI resolves it once per request)
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+    payload = _decode_cached(token)
+    # A cached payload can outlive its token, so check the expiry again on every request
+    if payload is None or payload.get('exp', float('inf')) <= time.time():
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+
+    email = payload.get('sub')
+    with _user_cache_lock:
+        user = _user_cache.get(email)
+    if user is None:
+        user = get_user_by_email(db, email)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        # Keep a detached copy in the cache so a later commit in this session can't expire it
+        db.expunge(user)
+        with _user_cache_lock:
+            _user_cache[email] = user
+    # Attach the cached row to this session without querying the database again
+    return db.merge(user, load=False)
 
 class SignupRequest(BaseModel):
     username: str
@@ -55,7 +91,7 @@ class TokenResponse(BaseModel):
 @auth_router.get("/", response_model=TokenResponse)
 async def root(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     payload = verify_token(token)
-    print(payload)
+    logger.debug("Token payload: %s", payload)
     if payload is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
     user = payload.get('sub')
@@ -1,59 +1,82 @@
+import codecs
 import io
+import logging
+import posixpath
+import socket
 import tarfile
+import threading
 import docker
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from models.container import Container
-from repositories.database_repository import get_db, get_user_by_email
-from controllers.auth import oauth2_scheme
+from models.container import Container, ContainerStatus
+from models.user import User
+from repositories.database_repository import get_db, get_user_container, get_user_containers
+from controllers.auth import get_current_user
 import asyncio
 from typing import Optional
 from fastapi import UploadFile, File
 import base64
-
-from repositories.auth_repository import verify_token
+from pathlib import PurePosixPath
 
 docker_router = APIRouter()
+logger = logging.getLogger(__name__)
 
 client = docker.from_env()
 
+# Inspect results per container, so a burst of requests on the same container shares one daemon call
+_container_cache = TTLCache(maxsize=1024, ttl=2)
+_container_cache_lock = threading.Lock()
+
+@cached(_container_cache, lock=_container_cache_lock)
+def _get_container(container_id: str):
+    return client.containers.get(container_id)
+
+def _invalidate_container(container_id: str):
+    with _container_cache_lock:
+        _container_cache.pop(hashkey(container_id), None)
+
+# Full /app listings per container, dropped whenever an endpoint changes the container's files
+_filesystem_cache = TTLCache(maxsize=256, ttl=5)
+_filesystem_cache_lock = threading.Lock()
+
+def _invalidate_filesystem(container_id: str):
+    with _filesystem_cache_lock:
+        _filesystem_cache.pop(container_id, None)
+
 class StartContainerRequest(BaseModel):
     user_mail: str
     token: str
 
 @docker_router.post("/docker/create-container")
-def create_container(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def create_container(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Start a Docker container with the specified image.
     :param image_name: The name of the Docker image to use (e.g., "nginx", "ubuntu")
     """
     try:
-        print(token)
-        payload = verify_token(token)
-
-        if payload == None: 
-            return {"message": "Invalid credentials"}
-
         IMAGE_NAME = "javierhersan/code-ai"
-        print(f"Starting container with image: {IMAGE_NAME}")
-        # Pull the image if not available locally
-        client.images.pull(IMAGE_NAME)
+        logger.info("Starting container with image: %s", IMAGE_NAME)
+        # Pull the image only if it isn't available locally
+        try:
+            client.images.get(IMAGE_NAME)
+        except docker.errors.ImageNotFound:
+            client.images.pull(IMAGE_NAME)
         # Start a container with the image
         container = client.containers.create(IMAGE_NAME)
         # container = client.containers.run(IMAGE_NAME, detach=True)
 
-        user = get_user_by_email(db, payload.get('sub'))
-        if user:
-            new_container = Container(
-                container_id=container.id, 
-                container_name=IMAGE_NAME, 
-                user_id=user.id,
-                status=container.status
-            )
-            db.add(new_container)
-            db.commit()
-            db.refresh(new_container)
+        new_container = Container(
+            container_id=container.id, 
+            container_name=IMAGE_NAME, 
+            user_id=user.id,
+            status=container.status
+        )
+        db.add(new_container)
+        db.commit()
+        db.refresh(new_container)
 
         return {"id":new_container.id, "container_id": new_container.id, "container_id": container.id, "container_name": IMAGE_NAME, "user_id":user.id, "status": container.status}
     
@@ -64,44 +87,23 @@ def create_container(token: str = Depends(oauth2_scheme), db: Session = Depends(
         raise HTTPException(status_code=500, detail=f"Error starting container: {str(e)}")
 
 @docker_router.get("/docker/user-containers")
-def list_user_containers(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def list_user_containers(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     List all containers associated with a user.
     """
-    token_payload = verify_token(token)
-    
-    if token_payload == None: 
-        return {"message": "Invalid credentials"}
-    
-    user = token_payload.get('sub')
-    
-    user = get_user_by_email(db, user)
-    if user:
-        containers = db.query(Container).filter(Container.user_id == user.id).all()
-        return {"containers": containers}
-    else:
-        raise HTTPException(status_code=404, detail="User not found.")
+    containers = get_user_containers(db, user.id)
+    return {"containers": containers}
 
 @docker_router.put("/docker/stop-container/{container_id}")
-def stop_user_container(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
+def stop_user_container(container_id: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         docker_container.stop()
+        _invalidate_container(container.container_id)
         
         container.status = 'exited'
         db.commit()
@@ -114,25 +116,15 @@ def stop_user_container(container_id: str, token: str = Depends(oauth2_scheme),
         raise HTTPException(status_code=500, detail=f"Error deleting container: {str(e)}")
     
 @docker_router.put("/docker/start-container/{container_id}")
-def start_user_container(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
+def start_user_container(container_id: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         docker_container.start()
+        _invalidate_container(container.container_id)
         
         container.status = 'running'
         db.commit()
@@ -145,29 +137,19 @@ def start_user_container(container_id: str, token: str = Depends(oauth2_scheme),
         raise HTTPException(status_code=500, detail=f"Error deleting container: {str(e)}")
 
 @docker_router.delete("/docker/delete-container/{container_id}")
-def delete_user_container(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def delete_user_container(container_id: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Delete a Docker container associated with a user.
     """
-    token_payload = verify_token(token)
-    
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
+    container = get_user_container(db, user.id, container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         docker_container.stop()
         docker_container.remove()
+        _invalidate_container(container.container_id)
         
         db.delete(container)
         db.commit()
@@ -180,73 +162,161 @@ def delete_user_container(container_id: str, token: str = Depends(oauth2_scheme)
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        # Send to everyone concurrently so one slow or broken client doesn't hold up the rest
+        await asyncio.gather(*(connection.send_text(message) for connection in list(self.active_connections)), return_exceptions=True)
 
 manager = ConnectionManager()
 
+# Batching window and size limit for terminal output sent over the websocket
+OUTPUT_FLUSH_INTERVAL = 0.005
+OUTPUT_FLUSH_SIZE = 16 * 1024
+# How long a closing terminal session waits for its reader task and thread to finish
+SESSION_CLEANUP_TIMEOUT = 1.0
+
+def _set_nodelay(sock):
+    # Keystrokes are tiny writes, so disable Nagle when the Docker daemon is reached over TCP
+    if isinstance(sock, socket.socket) and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def _pump_container_output(sock, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+    # Runs on its own thread for the whole session; None tells the event loop side the stream ended
+    try:
+        while True:
+            output = sock.recv(65536)
+            if not output:
+                break
+            loop.call_soon_threadsafe(queue.put_nowait, output)
+    except OSError as e:
+        logger.warning("Error reading from container: %s", e)
+    finally:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+        except RuntimeError:
+            pass  # The event loop is already closed
+
+def _close_exec_socket(sock):
+    # Shutting the socket down wakes a recv blocked on another thread
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError):
+        pass
+    sock.close()
+
 @docker_router.websocket("/docker-ws/{container_id}")
 async def websocket_endpoint(websocket: WebSocket, container_id: str):
     await manager.connect(websocket)
+    exec_socket = None
+    reader = None
+    read_task = None
     try:
-        container = client.containers.get(container_id) 
-        exec_instance = container.exec_run("/bin/sh", stdin=True, stdout=True, stderr=True, tty=True, detach=False, stream=True, socket=True)
-        output_stream = exec_instance.output
+        # Docker SDK calls block, so keep them off the event loop
+        container = await asyncio.to_thread(_get_container, container_id)
+        exec_instance = await asyncio.to_thread(container.exec_run, "/bin/sh", stdin=True, stdout=True, stderr=True, tty=True, detach=False, stream=True, socket=True)
+        # Read and write on the raw socket; on Unix hosts docker returns a SocketIO wrapper around it
+        exec_socket = getattr(exec_instance.output, '_sock', exec_instance.output)
+        _set_nodelay(exec_socket)
         data = ''
 
+        # A single reader thread owns the socket and hands chunks over through the queue
+        output_queue: asyncio.Queue = asyncio.Queue()
+        reader = threading.Thread(target=_pump_container_output, args=(exec_socket, asyncio.get_running_loop(), output_queue), daemon=True)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
         async def read_from_container():
             try:
-                print("Starting to read from container")
+                logger.debug("Starting to read from container")
+                loop = asyncio.get_running_loop()
                 while True:
-                    output = await asyncio.to_thread(output_stream.recv, 4096)
-                    if not output:
+                    output = await output_queue.get()
+                    if output is None:
+                        break
+                    # Wait a few milliseconds for more output unless the batch is already large,
+                    # so bursts of small reads don't become one websocket frame each
+                    batch = []
+                    batch_size = 0
+                    deadline = loop.time() + OUTPUT_FLUSH_INTERVAL
+                    while True:
+                        # The incremental decoder keeps multi-byte characters split across reads intact
+                        decoded_output = decoder.decode(output)
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Output of container: %r (last input: %r)", decoded_output, data.strip())
+                        # Drop the tty's echo of the last input; check each read on its own, since a
+                        # batch usually holds the echo together with the command's output
+                        if decoded_output and decoded_output.strip() != data.strip():
+                            batch.append(decoded_output)
+                        batch_size += len(output)
+                        timeout = deadline - loop.time()
+                        if batch_size >= OUTPUT_FLUSH_SIZE or timeout <= 0:
+                            break
+                        try:
+                            output = await asyncio.wait_for(output_queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                        if output is None:
+                            break
+
+                    if batch:
+                        await websocket.send_text("".join(batch))
+                    if output is None:
                         break
-                    decoded_output = output.decode('utf-8')
-                    print("Output of container: ", decoded_output)
-                    print("Data: ", data.strip())
-                    if decoded_output.strip() != data.strip():
-                        await websocket.send_text(decoded_output)
             except Exception as e:
-                print(f"Error reading from container: {e}")
+                logger.warning("Error sending container output: %s", e)
 
         async def write_to_container(input_data):
             try:
-                print("Writing to container: ", input_data)
-                await asyncio.to_thread(exec_instance.output.send, input_data.encode('utf-8'))
+                logger.debug("Writing to container: %r", input_data)
+                await asyncio.to_thread(exec_socket.sendall, input_data.encode('utf-8'))
             except Exception as e:
-                print(f"Error writing to container: {e}")
+                logger.warning("Error writing to container: %s", e)
 
+        reader.start()
         read_task = asyncio.create_task(read_from_container())
-        print("WebSocket connected")
+        logger.debug("WebSocket connected")
         while True:
-            try:
-                # Receive data from frontend terminal (xterm)
-                data = await websocket.receive_text()
-                # Send the received data to the Docker container
-                await write_to_container(data)
-            except WebSocketDisconnect:
-                manager.disconnect(websocket)
-                break
-
-        # Clean up when WebSocket disconnects
-        read_task.cancel()
+            # Receive data from frontend terminal (xterm)
+            data = await websocket.receive_text()
+            # Send the received data to the Docker container
+            await write_to_container(data)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
     except Exception as e:
-        await manager.disconnect(websocket)
+        logger.warning("Terminal session for container %s failed: %s", container_id, e)
+    finally:
+        # Clean up when WebSocket disconnects, however the session ended; the synchronous steps
+        # come first so the exec socket is released even if the handler itself was cancelled
+        manager.disconnect(websocket)
+        if read_task is not None:
+            read_task.cancel()
+        if exec_socket is not None:
+            _close_exec_socket(exec_socket)
+        if read_task is not None:
+            await asyncio.wait({read_task}, timeout=SESSION_CLEANUP_TIMEOUT)
+        if reader is not None:
+            await asyncio.to_thread(reader.join, SESSION_CLEANUP_TIMEOUT)
+
+# The IDE only works with files inside this folder of the container
+APP_ROOT = PurePosixPath("/app")
+
+def _validate_app_path(path: str, allow_root: bool = True) -> str:
+    parsed = PurePosixPath(path)
+    if "\x00" in path or not parsed.is_absolute() or ".." in parsed.parts:
+        raise HTTPException(status_code=400, detail="Invalid path")
+    if APP_ROOT not in parsed.parents and (parsed != APP_ROOT or not allow_root):
+        raise HTTPException(status_code=400, detail=f"Path must be inside {APP_ROOT}")
+    return str(parsed)
 
 class FileSystemItem(BaseModel):
     name: str
@@ -258,67 +328,56 @@ class FileSystemItem(BaseModel):
     isSaved: bool
     isOpen: bool
 
-@docker_router.get("/docker/filesystem/{container_id}")
-def get_filesystem(container_id: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
+# Fields that are the same for every listed item of a kind; the listing is server-generated, so it skips validation
+_ITEM_DEFAULTS = {"handle": None, "content": None, "isSaved": True, "isOpen": False}
+_DIRECTORY_DEFAULTS = {**_ITEM_DEFAULTS, "kind": "directory"}
+_FILE_DEFAULTS = {**_ITEM_DEFAULTS, "kind": "file"}
+
+def _find_filesystem_items(docker_container, path: str, *options: str) -> list[FileSystemItem]:
+    # Print each entry's type next to its path so directories and files come back from a single exec
+    exec_result = docker_container.exec_run(["find", path, *options, "-printf", "%y\\t%p\\n"], tty=False, demux=True)
+
+    if exec_result.exit_code != 0:
+        raise HTTPException(status_code=500, detail="Error retrieving file system structure")
+
+    stdout, _ = exec_result.output
+    entries = [line.partition("\t") for line in (stdout or b"").decode("utf-8").split("\n")]
+    directories_output = [item for kind, _, item in entries if kind == "d"]
+    files_output = [item for kind, _, item in entries if kind == "f"]
+
+    files = []
+    for item in directories_output:
+        parent_path, _, name = item.rpartition('/')
+        files.append(FileSystemItem.model_construct(name=name, path=item, parentPath=parent_path or None, **_DIRECTORY_DEFAULTS))
+    for item in files_output:
+        parent_path, _, name = item.rpartition('/')
+        files.append(FileSystemItem.model_construct(name=name, path=item, parentPath=parent_path or None, **_FILE_DEFAULTS))
+
+    return files
+
+@docker_router.get("/docker/filesystem/{container_id}", response_model=list[FileSystemItem])
+def get_filesystem(container_id: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    # Start and stop keep the stored status current, so a stopped container never costs a daemon call
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to list all files and directories
-        exec_result_directories = docker_container.exec_run("find /app -type d -exec echo {} \\;", tty=True)
-        exec_result_files = docker_container.exec_run("find /app -type f -exec echo {} \\;", tty=True)
-
-        if exec_result_directories.exit_code != 0 and exec_result_files.exit_code != 0:
-            raise HTTPException(status_code=500, detail="Error retrieving file system structure")
-        
-        directories_output = exec_result_directories.output.decode("utf-8").strip().split("\n")
-        files_output = exec_result_files.output.decode("utf-8").strip().split("\n")
-        
-        files = []
-        for item in directories_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind='directory',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        for item in files_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind= 'file',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
+        with _filesystem_cache_lock:
+            files = _filesystem_cache.get(container.container_id)
+        if files is None:
+            files = _find_filesystem_items(docker_container, str(APP_ROOT))
+            with _filesystem_cache_lock:
+                _filesystem_cache[container.container_id] = files
         
-        print(files)
         return files
 
     except docker.errors.NotFound:
@@ -326,70 +385,29 @@ def get_filesystem(container_id: str, token: str = Depends(oauth2_scheme), db: S
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving file system structure: {str(e)}")
 
-@docker_router.get("/docker/filesystem/{container_id}/{path}")
-def get_container_folder_content(container_id: str, path: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
+@docker_router.get("/docker/filesystem/{container_id}/{path}", response_model=list[FileSystemItem])
+def get_container_folder_content(container_id: str, path: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
     try:
-        docker_container = client.containers.get(container.container_id)
+        decoded_path= base64.b64decode(path).decode('utf-8')
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid path")
+    decoded_path = _validate_app_path(decoded_path)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
+    try:
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to list all files and directories
-        exec_result_directories = docker_container.exec_run("find /app -type d -exec echo {} \\;", tty=True)
-        exec_result_files = docker_container.exec_run("find /app -type f -exec echo {} \\;", tty=True)
-
-        if exec_result_directories.exit_code != 0 and exec_result_files.exit_code != 0:
-            raise HTTPException(status_code=500, detail="Error retrieving file system structure")
-        
-        directories_output = exec_result_directories.output.decode("utf-8").strip().split("\n")
-        files_output = exec_result_files.output.decode("utf-8").strip().split("\n")
-
-        decoded_path= base64.b64decode(path).decode('utf-8')
-        
-        files = []
-        for item in directories_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind='directory',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        for item in files_output:
-            item = item.strip() 
-            parent_path = '/'.join(item.split('/')[:-1]) or None
-            files.append(FileSystemItem(
-                name=item.split('/')[-1],
-                path=item,
-                parentPath=parent_path,
-                kind= 'file',
-                handle=None,
-                content=None,
-                isSaved=True,
-                isOpen=False
-            ))
-        
-        files = [file for file in files if file.parentPath and decoded_path in file.parentPath]
+        # Only the folder's immediate children are needed, so don't walk the whole tree
+        files = _find_filesystem_items(docker_container, decoded_path, "-mindepth", "1", "-maxdepth", "1")
 
         return files
 
@@ -398,43 +416,74 @@ def get_container_folder_content(container_id: str, path: str, token: str = Depe
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving file system structure: {str(e)}")    
 
+# Symlinks are followed like cat does, up to this many links in a row
+MAX_SYMLINK_HOPS = 8
+
+def _read_container_file(docker_container, file_path: str) -> bytes:
+    # Copy the file out through the archive API, which returns its bytes untouched by a TTY
+    for _ in range(MAX_SYMLINK_HOPS + 1):
+        try:
+            bits, _ = docker_container.get_archive(file_path)
+        except docker.errors.NotFound:
+            raise HTTPException(status_code=404, detail="File not found")
+        tar_stream = io.BytesIO()
+        for chunk in bits:
+            tar_stream.write(chunk)
+        tar_stream.seek(0)
+
+        with tarfile.open(fileobj=tar_stream, mode='r') as tar:
+            member = tar.next()
+            if member is not None and member.issym():
+                # The archive only holds the link itself, so fetch its target, which must also be inside /app
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(file_path), member.linkname))
+                file_path = _validate_app_path(target, allow_root=False)
+                continue
+            if member is None or not member.isfile():
+                raise HTTPException(status_code=400, detail="Path is not a file")
+            return tar.extractfile(member).read()
+
+    raise HTTPException(status_code=400, detail="Too many levels of symbolic links")
+
 @docker_router.get("/docker/file-content/{container_id}")
-def get_file_content(container_id: str, file_path: str, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == container_id, Container.user_id == user.id).first()
+def get_file_content(container_id: str, file_path: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    file_path = _validate_app_path(file_path, allow_root=False)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
-        # Execute the command to read the file content
-        exec_result = docker_container.exec_run(f"cat {file_path}", tty=True)
-
-        if exec_result.exit_code != 0:
-            raise HTTPException(status_code=500, detail="Error retrieving file content")
-        
-        file_content = exec_result.output.decode("utf-8").strip()
+        file_content = _read_container_file(docker_container, file_path).decode("utf-8")
         
         return file_content
 
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail="Docker container not found")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving file content: {str(e)}")
     
+def _single_file_tar(name: str, data: bytes):
+    # Stream the tar header, the content and the padding as they are, without building the archive in memory
+    tarinfo = tarfile.TarInfo(name=name)
+    tarinfo.size = len(data)
+    yield tarinfo.tobuf()
+    yield data
+    remainder = len(data) % tarfile.BLOCKSIZE
+    if remainder:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    # Two empty blocks mark the end of the archive
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
 class SaveContainerFile(BaseModel):
     container_id: str
     name: str
@@ -442,23 +491,21 @@ class SaveContainerFile(BaseModel):
     content: str
     
 @docker_router.post("/docker/save-file-content")
-def save_file_content(req:SaveContainerFile, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
+def save_file_content(req:SaveContainerFile, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, req.container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    if req.name in ("", ".", "..") or PurePosixPath(req.name).name != req.name:
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    parent_path = _validate_app_path(req.parent_path)
+    _validate_app_path(f"{parent_path}/{req.name}", allow_root=False)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
@@ -466,16 +513,9 @@ def save_file_content(req:SaveContainerFile, token: str = Depends(oauth2_scheme)
         # Normalize newlines to Unix-style
         normalized_content = req.content.replace('\r\n', '\n')
 
-        # Create an in-memory tar archive containing the file
-        tar_stream = io.BytesIO()
-        with tarfile.open(fileobj=tar_stream, mode='w') as tar:
-            tarinfo = tarfile.TarInfo(name=req.name)
-            tarinfo.size = len(normalized_content.encode('utf-8'))
-            tar.addfile(tarinfo, io.BytesIO(normalized_content.encode('utf-8')))
-        tar_stream.seek(0)
-        
-        # Upload the tar archive to the Docker container
-        docker_container.put_archive(path=req.parent_path, data=tar_stream)
+        # Upload the file to the Docker container as a single-entry tar archive
+        docker_container.put_archive(path=parent_path, data=_single_file_tar(req.name, normalized_content.encode('utf-8')))
+        _invalidate_filesystem(container.container_id)
         
         return {"message": "File content saved successfully"}
 
@@ -491,33 +531,30 @@ class MoveContainerItem(BaseModel):
     destination_path: str
 
 @docker_router.post("/docker/move-item")
-def move_item(req: MoveContainerItem, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
+def move_item(req: MoveContainerItem, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, req.container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    source_path = _validate_app_path(req.source_path, allow_root=False)
+    destination_path = _validate_app_path(req.destination_path)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
         # Execute the command to move the file or folder
-        exec_result = docker_container.exec_run(f"mv {req.source_path} {req.destination_path}", tty=True)
+        exec_result = docker_container.exec_run(["mv", source_path, destination_path], tty=False, demux=True)
 
         if exec_result.exit_code != 0:
             raise HTTPException(status_code=500, detail="Error moving item")
         
+        _invalidate_filesystem(container.container_id)
         return {"message": "Item moved successfully"}
 
     except docker.errors.NotFound:
@@ -530,34 +567,30 @@ class CreateFolderRequest(BaseModel):
     folder_path: str
 
 @docker_router.post("/docker/create-folder")
-def create_folder(req: CreateFolderRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
+def create_folder(req: CreateFolderRequest, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, req.container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    folder_path = _validate_app_path(req.folder_path, allow_root=False)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
         # Execute the command to create the folder
         
-        exec_result = docker_container.exec_run(f"mkdir -p {req.folder_path}", tty=True)
+        exec_result = docker_container.exec_run(["mkdir", "-p", folder_path], tty=False, demux=True)
 
         if exec_result.exit_code != 0:
             raise HTTPException(status_code=500, detail="Error creating folder")
         
+        _invalidate_filesystem(container.container_id)
         return {"message": "Folder created successfully"}
 
     except docker.errors.NotFound:
@@ -570,33 +603,29 @@ class CreateFileRequest(BaseModel):
     file_path: str
 
 @docker_router.post("/docker/create-file")
-def create_file(req: CreateFileRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
+def create_file(req: CreateFileRequest, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, req.container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    file_path = _validate_app_path(req.file_path, allow_root=False)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
         # Execute the command to create the file
-        exec_result = docker_container.exec_run(f"touch {req.file_path}", tty=True)
+        exec_result = docker_container.exec_run(["touch", file_path], tty=False, demux=True)
 
         if exec_result.exit_code != 0:
             raise HTTPException(status_code=500, detail="Error creating file")
         
+        _invalidate_filesystem(container.container_id)
         return {"message": "File created successfully"}
 
     except docker.errors.NotFound:
@@ -609,33 +638,29 @@ class RemovePathRequest(BaseModel):
     path: str
 
 @docker_router.post("/docker/remove-path")
-def remove_path(req: RemovePathRequest, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token_payload = verify_token(token)
-    if token_payload is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = token_payload.get('sub')
-    user = get_user_by_email(db, user)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    container = db.query(Container).filter(Container.container_id == req.container_id, Container.user_id == user.id).first()
+def remove_path(req: RemovePathRequest, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    container = get_user_container(db, user.id, req.container_id)
     if not container:
         raise HTTPException(status_code=404, detail="Container not found or does not belong to the user")
     
+    path = _validate_app_path(req.path, allow_root=False)
+    
+    if container.status != ContainerStatus.running:
+        raise HTTPException(status_code=400, detail="Container is not running")
+    
     try:
-        docker_container = client.containers.get(container.container_id)
+        docker_container = _get_container(container.container_id)
         
         if docker_container.status != 'running':
             raise HTTPException(status_code=400, detail="Container is not running")
         
         # Execute the command to remove the file or folder
-        exec_result = docker_container.exec_run(f"rm -rf {req.path}", tty=True)
+        exec_result = docker_container.exec_run(["rm", "-rf", path], tty=False, demux=True)
 
         if exec_result.exit_code != 0:
             raise HTTPException(status_code=500, detail="Error removing path")
         
+        _invalidate_filesystem(container.container_id)
         return {"message": "Path removed successfully"}
 
     except docker.errors.NotFound:
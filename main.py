@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+from anyio import to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from controllers.auth import auth_router
@@ -9,8 +11,14 @@ env = os.getenv('env', 'localhost')
 env_file = f".env.{env}"
 load_dotenv(env_file)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sync endpoints wait on Docker API calls in the threadpool, so allow more of them than the default 40
+    to_thread.current_default_thread_limiter().total_tokens = int(os.getenv("THREADPOOL_SIZE", "100"))
+    yield
+
 # Create the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 frontend_url = os.getenv("FRONTEND_URL")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from models.base import Base
@@ -12,6 +12,10 @@ class ContainerStatus(enum.Enum):
 
 class Container(Base):
     __tablename__ = "containers"
+    __table_args__ = (
+        # Covers the per-user listing and the (container_id, user_id) ownership checks
+        Index("ix_container_user_cid", "user_id", "container_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     container_id = Column(String, unique=True, index=True)  # Docker container ID
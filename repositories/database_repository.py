@@ -17,6 +17,10 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # User.metadata.create_all(bind=engine)
 # Container.metadata.create_all(bind=engine)
 Base.metadata.create_all(bind=engine)
+# create_all skips existing tables, so also add indexes declared after a table was first created
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
 
 # Dependency to get DB session
 def get_db():
@@ -53,3 +57,10 @@ def get_user_by_email_or_username(db: Session, email: str, username: str):
 def get_user_by_email(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
 
+# Function to get the containers owned by a user
+def get_user_containers(db: Session, user_id: int):
+    return db.query(Container).filter(Container.user_id == user_id).all()
+
+# Function to get a container only if it belongs to the user
+def get_user_container(db: Session, user_id: int, container_id: str):
+    return db.query(Container).filter(Container.container_id == container_id, Container.user_id == user_id).first()